@@ -1,19 +1,36 @@
 from fastapi import FastAPI, APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference
+import asyncio
+import heapq
 import os
 import logging
+import math
+import re
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
 from typing import List, Optional
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime, timezone
 import httpx
+import numpy as np
+import orjson
+import pygeohash
 import socketio
 import random
+from sortedcontainers import SortedList
+from itertools import count
+
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    rtree_index = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -23,6 +40,13 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Read-only view for listing endpoints: serving them from a secondary (when
+# a replica set provides one) keeps the primary free for SOS/companion
+# writes. Write paths and read-your-write lookups stay on the primary.
+companions_ro = db.companions.with_options(
+    read_preference=ReadPreference.SECONDARY_PREFERRED
+)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -30,28 +54,241 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shared HTTP client (created on startup, closed on shutdown)
+# Reusing one client keeps connections pooled across requests instead of
+# paying a fresh TCP+TLS handshake for every outbound call
+http_client: Optional[httpx.AsyncClient] = None
+
+# Process-lifetime YOLOv8 model, loaded once at startup instead of per request
+# (loading weights costs seconds; inference on a warm model is milliseconds)
+yolo_model = None
+
+# Detection classes relevant for safety scoring, resolved to model class ids
+# at load time so the per-box filter is an int set lookup
+YOLO_CLASSES_OF_INTEREST = {'person', 'camera', 'traffic light', 'car', 'truck', 'motorcycle'}
+yolo_keep_class_ids = frozenset()
+
+# Quantized engine exported offline with:
+#   YOLO('yolov8n.pt').export(format='openvino', int8=True)
+# int8 is adequate for the coarse classes above and roughly doubles CPU throughput
+YOLO_EXPORT_DIR = ROOT_DIR / 'yolov8n_openvino_model'
+
+def load_yolo_model():
+    """Load YOLOv8 once, preferring the int8 OpenVINO export over the FP32 .pt"""
+    try:
+        from ultralytics import YOLO
+    except ImportError:
+        logger.warning("ultralytics YOLOv8 not installed, detection will use mock results")
+        return None
+    try:
+        if YOLO_EXPORT_DIR.is_dir():
+            logger.info(f"Loading quantized YOLOv8 export from {YOLO_EXPORT_DIR}")
+            return YOLO(str(YOLO_EXPORT_DIR))
+        return YOLO('yolov8n.pt')
+    except Exception as e:
+        logger.error(f"Could not load YOLOv8 model: {e}")
+        return None
+
+class BufferedWriter:
+    """Batch insert_one calls into periodic insert_many flushes
+
+    Documents carry client-generated UUIDs, so endpoints can respond before
+    the write is acknowledged; the background task drains the buffer every
+    50ms, or immediately once it reaches max_batch, in a single bulk write.
+    """
+
+    def __init__(self, collection_name: str, max_batch: int = 100, interval: float = 0.05):
+        self.collection_name = collection_name
+        self.max_batch = max_batch
+        self.interval = interval
+        self._pending: List[dict] = []
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Cancel the flush task and drain whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+
+    def add(self, doc: dict):
+        self._pending.append(doc)
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    async def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await db[self.collection_name].insert_many(batch, ordered=False)
+        except Exception as e:
+            logger.error(f"Buffered insert into {self.collection_name} failed: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self._flush()
+
+sos_writer = BufferedWriter('sos_alerts')
+companion_writer = BufferedWriter('companions')
+
+async def _create_index(collection, keys, **kwargs):
+    """Create one index, logging failures instead of raising
+
+    Guarded individually so one bad index (or legacy data it trips over)
+    can't prevent the remaining indexes from being created.
+    """
+    try:
+        await collection.create_index(keys, **kwargs)
+    except Exception as e:
+        logger.warning(f"Could not create index {keys} on {collection.name}: {e}")
+
+async def ensure_indexes():
+    """Create the indexes backing every query the API endpoints issue
+
+    Without these, lookups on user_id/status/id degrade to collection
+    scans as the data grows.
+    """
+    # Detections written before the 2dsphere index stored location as a
+    # raw {lat, lon} dict, which MongoDB would read as a legacy
+    # lon-first coordinate pair — indexing every old row with the axes
+    # swapped (and failing the index build outright for |lon| > 90).
+    # Rewrite them to GeoJSON Points (the server-side form of
+    # location_to_geojson) before the index is created.
+    try:
+        await db.cctv_detections.update_many(
+            {'location.lat': {'$exists': True}, 'location.type': {'$ne': 'Point'}},
+            [{'$set': {'location': {
+                'type': 'Point',
+                'coordinates': ['$location.lon', '$location.lat']
+            }}}]
+        )
+    except Exception as e:
+        logger.warning(f"Could not migrate legacy cctv_detections locations: {e}")
+    await _create_index(db.companions, [('status', 1), ('user_id', 1)])
+    await _create_index(db.users, 'user_id', unique=True)
+    await _create_index(db.routes, [('user_id', 1), ('status', 1)])
+    await _create_index(db.cctv_detections, 'id', unique=True)
+    await _create_index(db.cctv_detections, [('location', '2dsphere')])
+    await _create_index(db.sos_alerts, [('user_id', 1), ('timestamp', -1)])
+    await _create_index(db.companion_requests, 'to_user_id')
+
 # Lifespan event handler for FastAPI
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    global http_client, yolo_model, yolo_keep_class_ids
     logger.info("FastAPI application starting...")
+    yolo_model = load_yolo_model()
+    app.state.yolo = yolo_model
+    if yolo_model is not None:
+        yolo_keep_class_ids = frozenset(
+            class_id for class_id, name in yolo_model.names.items()
+            if name in YOLO_CLASSES_OF_INTEREST
+        )
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.warning(f"Could not ensure MongoDB indexes: {e}")
+    sos_writer.start()
+    companion_writer.start()
+    location_flush_task = asyncio.create_task(flush_location_updates())
+    if _proximity_kernel is not None:
+        # Warm the JIT off the event loop so the first real proximity
+        # query doesn't pay the compile
+        await asyncio.to_thread(
+            proximity_distances_km, 0.0, 0.0,
+            np.zeros(1), np.zeros(1), 1.0
+        )
+    # Pool sized for /api/route fan-out (OSRM + Overpass + TomTom per request);
+    # keepalive_expiry recycles sockets that Overpass/TomTom close server-side
+    max_connections = int(os.environ.get('HTTPX_MAX_CONN', '100'))
+    # http2=True lets the concurrent Overpass/TomTom requests from route
+    # scoring multiplex over one TLS session per host instead of one
+    # socket each (plain-HTTP hosts like OSRM stay on HTTP/1.1)
+    http_client = httpx.AsyncClient(
+        timeout=30.0,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(40, max_connections),
+            keepalive_expiry=30.0
+        )
+    )
+    app.state.http = http_client
     yield
     # Shutdown
     logger.info("FastAPI application shutting down...")
+    location_flush_task.cancel()
+    try:
+        await location_flush_task
+    except asyncio.CancelledError:
+        pass
+    await sos_writer.stop()
+    await companion_writer.stop()
+    await http_client.aclose()
+    http_client = None
     client.close()
 
-# Create the main app with lifespan
-app = FastAPI(lifespan=lifespan)
+# Create the main app with lifespan; orjson handles the float-heavy GeoJSON
+# payloads (thousands of coordinate pairs per route) several times faster
+# than the stdlib encoder and emits bytes directly
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Socket.IO setup for real-time features
+class OrjsonPacketJSON:
+    """Drop-in json module for socketio backed by orjson
+
+    socketio passes stdlib kwargs like separators and expects str back,
+    so dumps ignores the kwargs (orjson is always compact) and decodes.
+    OPT_SERIALIZE_NUMPY lets payloads carry numpy scalars/arrays from the
+    presence columns without a tolist() copy first.
+    """
+
+    @staticmethod
+    def dumps(obj, **kwargs) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+
+# Binary msgpack framing cuts the tiny location_update/bulk-broadcast
+# frames to roughly a third of their JSON size, but every connected client
+# must speak the matching parser — so it's opt-in per deployment via env,
+# with orjson-backed JSON remaining the default
+SOCKETIO_SERIALIZER = os.environ.get('SOCKETIO_SERIALIZER', 'default')
+
 sio = socketio.AsyncServer(
     async_mode='asgi',
-    cors_allowed_origins='*'
+    cors_allowed_origins='*',
+    serializer='msgpack' if SOCKETIO_SERIALIZER == 'msgpack' else 'default',
+    json=OrjsonPacketJSON
 )
-socket_app = socketio.ASGIApp(sio, app)
+
+# Mount the Socket.IO transport under FastAPI rather than wrapping FastAPI
+# in the socketio dispatcher: /api requests no longer pass through the
+# socketio path check, and the documented `uvicorn server:app` entrypoint
+# serves both HTTP and WebSocket traffic. socket_app stays as an alias for
+# any deployment still pointing at it.
+app.mount('/socket.io', socketio.ASGIApp(sio, socketio_path='/'))
+socket_app = app
 
 # API Keys placeholders
 TOMTOM_API_KEY = os.environ.get('TOMTOM_API_KEY', 'YOUR_TOMTOM_API_KEY_HERE')
@@ -139,6 +376,122 @@ class UserProfileUpdate(BaseModel):
 
 # ============ Helper Functions ============
 
+class TTLCache:
+    """Small in-process LRU cache with per-entry expiry for memoizing remote lookups"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._locks = {}  # key -> asyncio.Lock, serializes concurrent misses
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def lock(self, key) -> asyncio.Lock:
+        """Per-key lock so one fetch serves all concurrent misses for that key"""
+        if len(self._locks) > self.maxsize:
+            self._locks = {k: v for k, v in self._locks.items() if v.locked()}
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+# Overpass data for a neighbourhood is static over minutes-to-hours, so
+# repeated route queries along the same corridor can reuse cached results
+overpass_cache = TTLCache(maxsize=1024, ttl=600.0)
+
+# Users re-enter the same destinations constantly and Nominatim's usage
+# policy is strict (1 req/s), so geocode responses are cached for an hour
+geocode_cache = TTLCache(maxsize=4096, ttl=3600.0)
+
+# Composite safety scores keyed by route geometry; only worthwhile because
+# the per-factor scores below are deterministic for a given route
+safety_score_cache = TTLCache(maxsize=1024, ttl=600.0)
+
+def route_coordinates_key(coordinates: List[List[float]]) -> int:
+    """Stable hash of a route's geometry (subsampled and rounded to ~10m)"""
+    return hash(tuple(
+        (round(lon, 4), round(lat, 4)) for lon, lat in coordinates[::16]
+    ))
+
+def quantize_bbox(bbox: List[float]) -> tuple:
+    """Round a bbox to ~100m precision so nearby routes share cache entries"""
+    return tuple(round(value, 3) for value in bbox)
+
+def location_to_geojson(location: dict) -> dict:
+    """Normalize a {lat, lon} dict to a GeoJSON Point so the 2dsphere index applies"""
+    if location.get('type') == 'Point' and 'coordinates' in location:
+        return location
+    if 'lat' in location and 'lon' in location:
+        return {'type': 'Point', 'coordinates': [location['lon'], location['lat']]}
+    return location
+
+async def fetch_cctv_from_mongo(bbox: List[float]):
+    """Fetch user-verified CCTV detections in a bbox via the 2dsphere index"""
+    # bbox format: [min_lon, min_lat, max_lon, max_lat]
+    bbox_polygon = {
+        'type': 'Polygon',
+        'coordinates': [[
+            [bbox[0], bbox[1]],
+            [bbox[2], bbox[1]],
+            [bbox[2], bbox[3]],
+            [bbox[0], bbox[3]],
+            [bbox[0], bbox[1]]
+        ]]
+    }
+    docs = await db.cctv_detections.find(
+        {
+            'verified': True,
+            'location': {'$geoWithin': {'$geometry': bbox_polygon}}
+        },
+        {'_id': 0, 'id': 1, 'location': 1}
+    ).to_list(1000)
+
+    return [
+        {
+            'type': 'Feature',
+            'geometry': doc['location'],
+            'properties': {
+                'id': doc['id'],
+                'type': 'cctv',
+                'source': 'yolo_verified'
+            }
+        }
+        for doc in docs
+    ]
+
+def bbox_from_coordinates(coordinates: List[List[float]]) -> List[float]:
+    """Compute the [min_lon, min_lat, max_lon, max_lat] bbox of a route
+
+    Routes carry thousands of coordinate pairs, so the reduction runs as a
+    single NumPy pass; tiny inputs stay on the plain-Python path where the
+    array conversion would cost more than it saves.
+    """
+    if len(coordinates) < 16:
+        lons = [coord[0] for coord in coordinates]
+        lats = [coord[1] for coord in coordinates]
+        return [min(lons), min(lats), max(lons), max(lats)]
+
+    arr = np.asarray(coordinates, dtype=np.float64)
+    mins = arr.min(axis=0)
+    maxs = arr.max(axis=0)
+    return [float(mins[0]), float(mins[1]), float(maxs[0]), float(maxs[1])]
+
 async def fetch_osrm_route(start_lon: float, start_lat: float, end_lon: float, end_lat: float):
     """Fetch route from OSRM public API"""
     url = f"http://router.project-osrm.org/route/v1/driving/{start_lon},{start_lat};{end_lon},{end_lat}"
@@ -148,20 +501,19 @@ async def fetch_osrm_route(start_lon: float, start_lat: float, end_lon: float, e
     }
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('code') == 'Ok' and data.get('routes'):
-                route = data['routes'][0]
-                return {
-                    'geometry': route['geometry'],
-                    'distance': route['distance'],
-                    'duration': route['duration']
-                }
-            else:
-                raise HTTPException(status_code=404, detail="Route not found")
+        response = await http_client.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+
+        if data.get('code') == 'Ok' and data.get('routes'):
+            route = data['routes'][0]
+            return {
+                'geometry': route['geometry'],
+                'distance': route['distance'],
+                'duration': route['duration']
+            }
+        else:
+            raise HTTPException(status_code=404, detail="Route not found")
     except httpx.RequestError as e:
         logger.error(f"OSRM request error: {e}")
         raise HTTPException(status_code=503, detail="Routing service unavailable")
@@ -169,6 +521,11 @@ async def fetch_osrm_route(start_lon: float, start_lat: float, end_lon: float, e
 async def fetch_cctv_from_overpass(bbox: List[float]):
     """Fetch CCTV cameras from Overpass API (OpenStreetMap)"""
     # bbox format: [min_lon, min_lat, max_lon, max_lat]
+    key = ('cctv',) + quantize_bbox(bbox)
+    cached = overpass_cache.get(key)
+    if cached is not None:
+        return cached
+
     overpass_url = "https://overpass-api.de/api/interpreter"
     query = f"""
     [out:json];
@@ -178,18 +535,21 @@ async def fetch_cctv_from_overpass(bbox: List[float]):
     );
     out;
     """
-    
+
     params = {
         'data': query,
         'bbox': f"{bbox[1]},{bbox[0]},{bbox[3]},{bbox[2]}"
     }
-    
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(overpass_url, params=params)
+
+    async with overpass_cache.lock(key):
+        cached = overpass_cache.get(key)
+        if cached is not None:
+            return cached
+        try:
+            response = await http_client.get(overpass_url, params=params)
             response.raise_for_status()
             data = response.json()
-            
+
             cctv_points = []
             for element in data.get('elements', []):
                 if 'lat' in element and 'lon' in element:
@@ -204,11 +564,12 @@ async def fetch_cctv_from_overpass(bbox: List[float]):
                             'type': 'cctv'
                         }
                     })
-            
+
+            overpass_cache.set(key, cctv_points)
             return cctv_points
-    except Exception as e:
-        logger.error(f"Overpass API error: {e}")
-        return []
+        except Exception as e:
+            logger.error(f"Overpass API error: {e}")
+            return []
 
 async def get_tomtom_traffic_score(start_lon: float, start_lat: float, end_lon: float, end_lat: float) -> float:
     """Get traffic score from TomTom Traffic API
@@ -233,24 +594,23 @@ async def get_tomtom_traffic_score(start_lon: float, start_lat: float, end_lon:
             'key': tomtom_api_key
         }
         
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('flowSegmentData'):
-                flow_data = data['flowSegmentData']
-                # freeFlowSpeed is max speed, currentSpeed is actual speed
-                free_flow_speed = flow_data.get('freeFlowSpeed', 100)
-                current_speed = flow_data.get('currentSpeed', free_flow_speed)
-                
-                # Calculate traffic score based on speed ratio
-                # 100% speed = 100 score, 50% speed = 50 score, etc.
-                traffic_score = min(100, (current_speed / free_flow_speed) * 100)
-                logger.info(f"TomTom Traffic: {current_speed}/{free_flow_speed} km/h = {traffic_score} score")
-                return round(traffic_score, 2)
-            
-            return 75.0
+        response = await http_client.get(url, params=params, timeout=15.0)
+        response.raise_for_status()
+        data = response.json()
+
+        if data.get('flowSegmentData'):
+            flow_data = data['flowSegmentData']
+            # freeFlowSpeed is max speed, currentSpeed is actual speed
+            free_flow_speed = flow_data.get('freeFlowSpeed', 100)
+            current_speed = flow_data.get('currentSpeed', free_flow_speed)
+
+            # Calculate traffic score based on speed ratio
+            # 100% speed = 100 score, 50% speed = 50 score, etc.
+            traffic_score = min(100, (current_speed / free_flow_speed) * 100)
+            logger.info(f"TomTom Traffic: {current_speed}/{free_flow_speed} km/h = {traffic_score} score")
+            return round(traffic_score, 2)
+
+        return 75.0
     except Exception as e:
         logger.warning(f"TomTom API error: {e}, using default traffic score")
         return 75.0
@@ -266,8 +626,11 @@ async def get_traffic_score(coordinates: List[List[float]]):
             return 75.0
         
         # Currently using mock but realistic traffic scoring
-        # Varies based on route characteristics
-        base_score = random.uniform(65, 95)
+        # Varies based on route characteristics; seeding an RNG from the
+        # geometry makes the score deterministic per route, so upstream
+        # caches actually hit and unit tests see stable values
+        rng = random.Random(route_coordinates_key(coordinates))
+        base_score = rng.uniform(65, 95)
         logger.info(f"Traffic Score: {base_score}")
         return round(base_score, 2)
     except Exception as e:
@@ -278,21 +641,12 @@ async def get_cctv_score(coordinates: List[List[float]]):
     """Calculate CCTV coverage score along route from OpenStreetMap"""
     try:
         # Calculate bounding box from coordinates
-        lons = [coord[0] for coord in coordinates]
-        lats = [coord[1] for coord in coordinates]
-        bbox = [min(lons), min(lats), max(lons), max(lats)]
-        
+        bbox = bbox_from_coordinates(coordinates)
+
         # Fetch CCTV cameras from Overpass API (OpenStreetMap)
         cctv_points = await fetch_cctv_from_overpass(bbox)
-        
-        # Scoring based on actual CCTV count from OpenStreetMap
-        # More cameras = higher coverage = higher score
-        cctv_count = len(cctv_points)
-        # Formula: each 5 cameras = 10% score, max 100%
-        score = min(100, (cctv_count / 5) * 10)
-        
-        logger.info(f"CCTV Score: {cctv_count} cameras found, score: {score}")
-        return round(score, 2)
+
+        return cctv_score_from_count(len(cctv_points))
     except Exception as e:
         logger.warning(f"CCTV score calculation error: {e}")
         return 50.0
@@ -300,6 +654,11 @@ async def get_cctv_score(coordinates: List[List[float]]):
 async def fetch_infrastructure_from_overpass(bbox: List[float]):
     """Fetch public infrastructure from Overpass API (OpenStreetMap)"""
     # bbox format: [min_lon, min_lat, max_lon, max_lat]
+    key = ('infrastructure',) + quantize_bbox(bbox)
+    cached = overpass_cache.get(key)
+    if cached is not None:
+        return cached
+
     overpass_url = "https://overpass-api.de/api/interpreter"
     query = f"""
     [out:json];
@@ -312,18 +671,21 @@ async def fetch_infrastructure_from_overpass(bbox: List[float]):
     );
     out;
     """
-    
+
     params = {
         'data': query,
         'bbox': f"{bbox[1]},{bbox[0]},{bbox[3]},{bbox[2]}"
     }
-    
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(overpass_url, params=params)
+
+    async with overpass_cache.lock(key):
+        cached = overpass_cache.get(key)
+        if cached is not None:
+            return cached
+        try:
+            response = await http_client.get(overpass_url, params=params)
             response.raise_for_status()
             data = response.json()
-            
+
             infrastructure_points = []
             for element in data.get('elements', []):
                 if 'lat' in element and 'lon' in element:
@@ -341,48 +703,177 @@ async def fetch_infrastructure_from_overpass(bbox: List[float]):
                             'name': tags.get('name', infrastructure_type)
                         }
                     })
-            
+
+            overpass_cache.set(key, infrastructure_points)
             return infrastructure_points
-    except Exception as e:
-        logger.error(f"Overpass API error for infrastructure: {e}")
-        return []
+        except Exception as e:
+            logger.error(f"Overpass API error for infrastructure: {e}")
+            return []
 
 async def get_crowd_score(coordinates: List[List[float]]):
     """Calculate crowd density score based on infrastructure density"""
     try:
         # Calculate bounding box from coordinates
-        lons = [coord[0] for coord in coordinates]
-        lats = [coord[1] for coord in coordinates]
-        bbox = [min(lons), min(lats), max(lons), max(lats)]
-        
+        bbox = bbox_from_coordinates(coordinates)
+
         # Fetch infrastructure (indicator of crowds/activity)
         infrastructure_points = await fetch_infrastructure_from_overpass(bbox)
-        
-        # More infrastructure = more likely to have crowds = potentially safer (busy areas)
-        infra_count = len(infrastructure_points)
-        # Formula: each 3 infrastructure points = 10% score, max 100%
-        score = min(100, (infra_count / 3) * 10)
-        
-        logger.info(f"Crowd Score: {infra_count} infrastructure points found, score: {score}")
-        return round(score, 2)
+
+        return crowd_score_from_count(len(infrastructure_points))
     except Exception as e:
         logger.warning(f"Crowd score calculation error: {e}")
         return 50.0
 
+async def fetch_pois_from_overpass(bbox: List[float]):
+    """Fetch CCTV cameras and public infrastructure in a single Overpass query
+
+    Overpass is rate-limited and is the slowest dependency on the route path,
+    so the surveillance and infrastructure filters are ORed into one query
+    and the results partitioned by tag locally, halving round-trips per route.
+    """
+    # bbox format: [min_lon, min_lat, max_lon, max_lat]
+    key = ('pois',) + quantize_bbox(bbox)
+    cached = overpass_cache.get(key)
+    if cached is not None:
+        return cached
+
+    overpass_url = "https://overpass-api.de/api/interpreter"
+    query = f"""
+    [out:json];
+    (
+      node["man_made"="surveillance"]({{bbox}});
+      node["surveillance:type"="camera"]({{bbox}});
+      node["amenity"="hospital"]({{bbox}});
+      node["amenity"="police"]({{bbox}});
+      node["amenity"="fire_station"]({{bbox}});
+      node["amenity"="ambulance_station"]({{bbox}});
+      node["emergency"="yes"]({{bbox}});
+    );
+    out;
+    """
+
+    params = {
+        'data': query,
+        'bbox': f"{bbox[1]},{bbox[0]},{bbox[3]},{bbox[2]}"
+    }
+
+    pois = {'cctv': [], 'infrastructure': []}
+    async with overpass_cache.lock(key):
+        cached = overpass_cache.get(key)
+        if cached is not None:
+            return cached
+        try:
+            response = await http_client.get(overpass_url, params=params)
+            response.raise_for_status()
+            data = response.json()
+
+            for element in data.get('elements', []):
+                if 'lat' not in element or 'lon' not in element:
+                    continue
+                tags = element.get('tags', {})
+                geometry = {
+                    'type': 'Point',
+                    'coordinates': [element['lon'], element['lat']]
+                }
+                if tags.get('man_made') == 'surveillance' or tags.get('surveillance:type') == 'camera':
+                    pois['cctv'].append({
+                        'type': 'Feature',
+                        'geometry': geometry,
+                        'properties': {
+                            'id': element['id'],
+                            'type': 'cctv'
+                        }
+                    })
+                else:
+                    infrastructure_type = tags.get('amenity', tags.get('emergency', 'unknown'))
+                    pois['infrastructure'].append({
+                        'type': 'Feature',
+                        'geometry': geometry,
+                        'properties': {
+                            'id': element['id'],
+                            'type': infrastructure_type,
+                            'name': tags.get('name', infrastructure_type)
+                        }
+                    })
+
+            overpass_cache.set(key, pois)
+            return pois
+        except Exception as e:
+            logger.error(f"Overpass API error for POIs: {e}")
+            return pois
+
+# How close a POI must sit to a route's polyline to count towards its score
+POI_CORRIDOR_M = 200.0
+
+def count_points_near_route(points: np.ndarray, coordinates: List[List[float]],
+                            max_distance_m: float = POI_CORRIDOR_M) -> int:
+    """Count POIs within max_distance_m of a route polyline
+
+    Distances use an equirectangular approximation broadcast over the
+    polyline vertices — exact enough at corridor scale and fully
+    vectorized. Long polylines are subsampled to bound the pairwise matrix.
+    """
+    if points.size == 0 or not coordinates:
+        return 0
+
+    route = np.asarray(coordinates, dtype=np.float64)
+    if len(route) > 512:
+        route = route[::len(route) // 512 + 1]
+
+    cos_lat = np.cos(np.radians(route[:, 1].mean()))
+    dlon = (points[:, 0][:, None] - route[:, 0][None, :]) * cos_lat
+    dlat = points[:, 1][:, None] - route[:, 1][None, :]
+    min_d2 = (dlon * dlon + dlat * dlat).min(axis=1)
+
+    max_deg = max_distance_m / 111320.0  # meters per degree of latitude
+    return int(np.count_nonzero(min_d2 <= max_deg * max_deg))
+
+def poi_coordinates(features: List[dict]) -> np.ndarray:
+    """Extract an (N, 2) lon/lat array from a list of GeoJSON features"""
+    return np.asarray(
+        [feature['geometry']['coordinates'] for feature in features],
+        dtype=np.float64
+    ).reshape(-1, 2)
+
+def cctv_score_from_count(cctv_count: int) -> float:
+    """Score CCTV coverage from a camera count (each 5 cameras = 10%, max 100%)"""
+    score = min(100, (cctv_count / 5) * 10)
+    logger.info(f"CCTV Score: {cctv_count} cameras found, score: {score}")
+    return round(score, 2)
+
+def crowd_score_from_count(infra_count: int) -> float:
+    """Score crowd density from an infrastructure count (each 3 points = 10%, max 100%)"""
+    # More infrastructure = more likely to have crowds = potentially safer (busy areas)
+    score = min(100, (infra_count / 3) * 10)
+    logger.info(f"Crowd Score: {infra_count} infrastructure points found, score: {score}")
+    return round(score, 2)
+
 async def calculate_safety_score(coordinates: List[List[float]]):
     """Calculate overall safety score based on multiple factors"""
-    traffic_score = await get_traffic_score(coordinates)
-    cctv_score = await get_cctv_score(coordinates)
-    crowd_score = await get_crowd_score(coordinates)
-    
+    key = route_coordinates_key(coordinates)
+    cached = safety_score_cache.get(key)
+    if cached is not None:
+        return cached
+
+    bbox = bbox_from_coordinates(coordinates)
+
+    traffic_score, pois = await asyncio.gather(
+        get_traffic_score(coordinates),
+        fetch_pois_from_overpass(bbox)
+    )
+    cctv_score = cctv_score_from_count(len(pois['cctv']))
+    crowd_score = crowd_score_from_count(len(pois['infrastructure']))
+
     # Weighted formula as specified
     safety_score = (
         0.4 * traffic_score +
         0.3 * cctv_score +
         0.3 * crowd_score
     )
-    
-    return round(safety_score, 2)
+
+    safety_score = round(safety_score, 2)
+    safety_score_cache.set(key, safety_score)
+    return safety_score
 
 # ============ API Endpoints ============
 
@@ -402,48 +893,73 @@ async def get_safest_route(request: RouteRequest):
             'alternatives': 'true'
         }
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            data = response.json()
-        
+        response = await http_client.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+
         if data.get('code') != 'Ok' or not data.get('routes'):
             raise HTTPException(status_code=400, detail="No routes found")
         
         routes = data['routes']
-        
+
+        # Alternative routes between the same endpoints overlap heavily, so
+        # issue one fused Overpass query over the union bbox and attribute
+        # POIs to each route by proximity to its polyline — one remote call
+        # instead of one per alternative, and corridor counts are more
+        # accurate than whole-bbox counts
+        union_bbox = bbox_from_coordinates(
+            [coord for route in routes for coord in route['geometry']['coordinates']]
+        )
+        pois = await fetch_pois_from_overpass(union_bbox)
+        cctv_coords = poi_coordinates(pois['cctv'])
+        infra_coords = poi_coordinates(pois['infrastructure'])
+
+        # Traffic scores for all routes still run in one gather so their
+        # remote round-trips overlap instead of serializing
+        async def score_route(route):
+            coordinates = route['geometry']['coordinates']
+            traffic_score = await get_traffic_score(coordinates)
+            cctv_score = cctv_score_from_count(
+                count_points_near_route(cctv_coords, coordinates)
+            )
+            crowd_score = crowd_score_from_count(
+                count_points_near_route(infra_coords, coordinates)
+            )
+            return route, traffic_score, cctv_score, crowd_score
+
+        scored = await asyncio.gather(
+            *(score_route(route) for route in routes),
+            return_exceptions=True
+        )
+
         # Evaluate all routes and pick the safest
         best_route = None
         best_safety_score = -1
         best_route_metrics = {}
-        
-        for route in routes:
-            try:
-                coordinates = route['geometry']['coordinates']
-                traffic_score = await get_traffic_score(coordinates)
-                cctv_score = await get_cctv_score(coordinates)
-                crowd_score = await get_crowd_score(coordinates)
-                
-                # Weighted formula
-                safety_score = (
-                    0.4 * traffic_score +
-                    0.3 * cctv_score +
-                    0.3 * crowd_score
-                )
-                safety_score = round(safety_score, 2)
-                
-                if safety_score > best_safety_score:
-                    best_safety_score = safety_score
-                    best_route = route
-                    best_route_metrics = {
-                        'traffic_score': round(traffic_score, 2),
-                        'cctv_score': round(cctv_score, 2),
-                        'crowd_score': round(crowd_score, 2),
-                        'route_type': 'safest'
-                    }
-            except Exception as e:
-                logger.warning(f"Error calculating safety score for route: {e}")
+
+        for result in scored:
+            if isinstance(result, Exception):
+                logger.warning(f"Error calculating safety score for route: {result}")
                 continue
+            route, traffic_score, cctv_score, crowd_score = result
+
+            # Weighted formula
+            safety_score = (
+                0.4 * traffic_score +
+                0.3 * cctv_score +
+                0.3 * crowd_score
+            )
+            safety_score = round(safety_score, 2)
+
+            if safety_score > best_safety_score:
+                best_safety_score = safety_score
+                best_route = route
+                best_route_metrics = {
+                    'traffic_score': round(traffic_score, 2),
+                    'cctv_score': round(cctv_score, 2),
+                    'crowd_score': round(crowd_score, 2),
+                    'route_type': 'safest'
+                }
         
         # Fallback to shortest route if safety calculation failed
         if best_route is None:
@@ -487,6 +1003,11 @@ async def get_safest_route(request: RouteRequest):
 @api_router.get("/geocode")
 async def geocode_address(query: str, limit: int = 5):
     """Geocode address using Nominatim (OpenStreetMap)"""
+    key = (query.strip().lower(), limit)
+    cached = geocode_cache.get(key)
+    if cached is not None:
+        return cached
+
     url = "https://nominatim.openstreetmap.org/search"
     params = {
         'q': query,
@@ -497,26 +1018,39 @@ async def geocode_address(query: str, limit: int = 5):
     headers = {
         'User-Agent': 'SafeRoute/1.0'
     }
-    
-    try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            response = await client.get(url, params=params, headers=headers)
+
+    async with geocode_cache.lock(key):
+        cached = geocode_cache.get(key)
+        if cached is not None:
+            return cached
+        try:
+            response = await http_client.get(url, params=params, headers=headers, timeout=15.0)
             response.raise_for_status()
-            return response.json()
-    except Exception as e:
-        logger.error(f"Geocoding error: {e}")
-        raise HTTPException(status_code=500, detail="Geocoding service error")
+            results = response.json()
+            geocode_cache.set(key, results)
+            return results
+        except Exception as e:
+            logger.error(f"Geocoding error: {e}")
+            raise HTTPException(status_code=500, detail="Geocoding service error")
 
 @api_router.get("/cctv")
 async def get_cctv_cameras(min_lon: float, min_lat: float, max_lon: float, max_lat: float):
-    """Get CCTV cameras in bounding box from OpenStreetMap"""
+    """Get CCTV cameras in bounding box from OpenStreetMap and verified detections"""
     bbox = [min_lon, min_lat, max_lon, max_lat]
     cctv_points = await fetch_cctv_from_overpass(bbox)
+
+    # Supplement with user-verified YOLO detections served straight from the
+    # 2dsphere index — these never need an Overpass round-trip
+    try:
+        cctv_points = cctv_points + await fetch_cctv_from_mongo(bbox)
+    except Exception as e:
+        logger.warning(f"Could not fetch local CCTV detections: {e}")
+
     return {
         'type': 'FeatureCollection',
         'features': cctv_points,
         'count': len(cctv_points),
-        'source': 'OpenStreetMap (Overpass API)'
+        'source': 'OpenStreetMap (Overpass API) + verified detections'
     }
 
 @api_router.get("/infrastructure")
@@ -546,10 +1080,9 @@ async def get_traffic_data(lon: float, lat: float, radius: float = 1.0):
 async def create_companion(companion: CompanionCreate):
     """Create a new companion for route sharing"""
     companion_obj = Companion(**companion.model_dump())
-    doc = companion_obj.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    
-    await db.companions.insert_one(doc)
+    # created_at stays a native datetime — stored as a BSON date, which
+    # avoids the stringify/reparse round-trip and keeps it range-queryable
+    companion_writer.add(companion_obj.model_dump())
     
     # Emit Socket.IO event for real-time updates
     await sio.emit('companion_joined', {
@@ -567,20 +1100,14 @@ async def get_companions(user_id: Optional[str] = None):
     if user_id:
         query['user_id'] = user_id
     
-    companions = await db.companions.find(query, {"_id": 0}).to_list(100)
-    
-    for companion in companions:
-        if isinstance(companion['created_at'], str):
-            companion['created_at'] = datetime.fromisoformat(companion['created_at'])
-    
-    return companions
+    # created_at comes back as a native datetime (BSON date); documents from
+    # before the migration hold ISO strings, which Pydantic coerces itself
+    return await companions_ro.find(query, {"_id": 0}).to_list(100)
 
 @api_router.post("/companions/request")
 async def send_companion_request(req: CompanionRequest):
     """Send a companion request to a nearby user and store it."""
-    doc = req.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
-    await db.companion_requests.insert_one(doc)
+    await db.companion_requests.insert_one(req.model_dump())
 
     # If target user is online, emit a socket event to notify them
     target = active_users.get(req.to_user_id)
@@ -588,7 +1115,7 @@ async def send_companion_request(req: CompanionRequest):
         'from_user_id': req.from_user_id,
         'to_user_id': req.to_user_id,
         'message': req.message,
-        'timestamp': doc['timestamp']
+        'timestamp': req.timestamp.isoformat()
     }
     if target and target.get('sid'):
         await sio.emit('companion_request', payload, to=target['sid'])
@@ -620,13 +1147,33 @@ async def create_sos_alert(sos: SOSRequest):
     """
     sos_alert = SOSAlert(**sos.model_dump())
     doc = sos_alert.model_dump()
-    doc['timestamp'] = doc['timestamp'].isoformat()
-    
+
     # Fetch user profile and active routes
     try:
-        user_profile = await db.users.find_one({'user_id': sos.user_id})
-        active_routes = await db.routes.find_one({'user_id': sos.user_id, 'status': 'active'})
-        
+        # Both lookups are independent, so run them concurrently; a failure
+        # in one branch must not cost the other on the emergency path.
+        # Project only the fields the snapshot needs — heavy profiles would
+        # otherwise be fully decoded just to pick five keys
+        user_profile, active_routes = await asyncio.gather(
+            db.users.find_one(
+                {'user_id': sos.user_id},
+                {'_id': 0, 'name': 1, 'phone': 1, 'emergency_contacts': 1,
+                 'health_info': 1, 'medical_conditions': 1}
+            ),
+            db.routes.find_one(
+                {'user_id': sos.user_id, 'status': 'active'},
+                {'_id': 0, 'destination': 1, 'start_location': 1,
+                 'estimated_arrival': 1, 'companions': 1}
+            ),
+            return_exceptions=True
+        )
+        if isinstance(user_profile, Exception):
+            logger.warning(f"Could not fetch user profile for SOS: {user_profile}")
+            user_profile = None
+        if isinstance(active_routes, Exception):
+            logger.warning(f"Could not fetch active route for SOS: {active_routes}")
+            active_routes = None
+
         if user_profile:
             # Store user info snapshot for emergency responders
             doc['user_profile'] = {
@@ -647,7 +1194,7 @@ async def create_sos_alert(sos: SOSRequest):
     except Exception as e:
         logger.warning(f"Could not fetch user profile/routes for SOS: {e}")
     
-    await db.sos_alerts.insert_one(doc)
+    sos_writer.add(doc)
     
     # Emit Socket.IO event for real-time emergency broadcast to nearby companions
     alert_data = {
@@ -665,13 +1212,46 @@ async def create_sos_alert(sos: SOSRequest):
     if 'active_route' in doc:
         alert_data['active_route'] = doc['active_route']
     
-    # Broadcast to all connected clients
-    await sio.emit('sos_alert', alert_data, to=None)
+    # Broadcast to clients in the alert's neighborhood (3x3 geohash cells)
+    # instead of every connected client; fall back to a global broadcast
+    # when the alert location carries no coordinates
+    lat, lon = sos_alert.location.get('lat'), sos_alert.location.get('lon')
+    if lat is not None and lon is not None:
+        for room in geo_rooms_around(lat, lon):
+            await sio.emit('sos_alert', alert_data, room=room)
+    else:
+        await sio.emit('sos_alert', alert_data, to=None)
     
     logger.warning(f"SOS Alert created: {sos_alert.id} at {sos_alert.location} by user {sos_alert.user_id}")
     
     return sos_alert
 
+async def save_mock_detection(request: CCTVDetectionRequest, note: str):
+    """Store and return a mock detection when YOLO inference is unavailable"""
+    logger.warning(note)
+    mock_detections = [
+        {
+            'class': 'camera',
+            'confidence': 0.87,
+            'bbox': [245, 120, 310, 180]
+        }
+    ]
+    detection = CCTVDetection(
+        location=request.location,
+        image_url=request.image_url,
+        detections=mock_detections,
+        confidence=0.87
+    )
+    doc = detection.model_dump()
+    doc['location'] = location_to_geojson(doc['location'])
+    await db.cctv_detections.insert_one(doc)
+    return {
+        'success': True,
+        'detection_id': detection.id,
+        'detections': mock_detections,
+        'note': note
+    }
+
 @api_router.post("/yolo/detect")
 async def detect_cctv_in_image(request: CCTVDetectionRequest):
     """YOLOv8 detection for CCTV cameras and surveillance objects in images
@@ -687,68 +1267,64 @@ async def detect_cctv_in_image(request: CCTVDetectionRequest):
     - Street view images
     - User-uploaded images
     """
+    if yolo_model is None:
+        # YOLOv8 not installed, return mock detection
+        return await save_mock_detection(request, 'YOLOv8 not installed - using mock detection')
+
     try:
-        from ultralytics import YOLO
         import cv2
-        
-        # Load YOLOv8 model (nano model for performance)
-        model = YOLO('yolov8n.pt')
-        
-        # Download and load image
-        import urllib.request
-        temp_image_path = '/tmp/temp_image.jpg'
-        
+
+        # Fetch image bytes through the shared async client and decode in
+        # memory: no blocking urllib call on the event loop, no /tmp write,
+        # and no race between concurrent requests on the same temp file
         try:
-            urllib.request.urlretrieve(request.image_url, temp_image_path)
+            response = await http_client.get(request.image_url, timeout=15.0)
+            response.raise_for_status()
         except Exception as e:
             logger.error(f"Could not download image from {request.image_url}: {e}")
             # Return mock detection if image fetch fails
-            mock_detections = [
-                {
-                    'class': 'camera',
-                    'confidence': 0.87,
-                    'bbox': [245, 120, 310, 180]
-                }
-            ]
-            detection = CCTVDetection(
-                location=request.location,
-                image_url=request.image_url,
-                detections=mock_detections,
-                confidence=0.87
-            )
-            doc = detection.model_dump()
-            doc['created_at'] = doc['created_at'].isoformat()
-            await db.cctv_detections.insert_one(doc)
-            return {
-                'success': True,
-                'detection_id': detection.id,
-                'detections': mock_detections,
-                'note': 'Using mock detection due to image fetch error'
-            }
-        
-        # Run YOLO inference
-        results = model(temp_image_path)
-        
-        # Extract relevant detections (cameras, people)
+            return await save_mock_detection(request, 'Using mock detection due to image fetch error')
+
+        image = cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            logger.error(f"Could not decode image from {request.image_url}")
+            return await save_mock_detection(request, 'Using mock detection due to image decode error')
+
+        # Run YOLO inference on the shared process-lifetime model, in a
+        # worker thread so CPU-bound inference doesn't stall the event loop
+        results = await asyncio.to_thread(yolo_model, image)
+
+        # Extract relevant detections (cameras, people): pull the class,
+        # confidence and box tensors out once per result and filter with a
+        # single numpy mask instead of per-box Python attribute access
         detections = []
         max_confidence = 0
-        
+        keep_ids = np.fromiter(yolo_keep_class_ids, dtype=np.int64)
+
         for result in results:
-            for detection in result.boxes:
-                class_id = int(detection.cls[0])
-                class_name = model.names[class_id]
-                confidence = float(detection.conf[0])
-                bbox = detection.xyxy[0].tolist()  # [x1, y1, x2, y2]
-                
-                # Filter for security-relevant objects
-                if class_name in ['person', 'camera', 'traffic light', 'car', 'truck', 'motorcycle']:
-                    detections.append({
-                        'class': class_name,
-                        'confidence': round(confidence, 3),
-                        'bbox': [round(x) for x in bbox]  # Convert to int
-                    })
-                    max_confidence = max(max_confidence, confidence)
-        
+            boxes = result.boxes
+            if boxes is None or len(boxes) == 0:
+                continue
+
+            cls = boxes.cls.cpu().numpy().astype(np.int64)
+            mask = np.isin(cls, keep_ids)  # security-relevant objects only
+            if not mask.any():
+                continue
+
+            cls = cls[mask]
+            conf = boxes.conf.cpu().numpy()[mask]
+            xyxy = boxes.xyxy.cpu().numpy()[mask].round().astype(int)  # [x1, y1, x2, y2]
+
+            detections.extend(
+                {
+                    'class': yolo_model.names[class_id],
+                    'confidence': round(confidence, 3),
+                    'bbox': bbox.tolist()  # Convert to int
+                }
+                for class_id, confidence, bbox in zip(cls.tolist(), conf.tolist(), xyxy)
+            )
+            max_confidence = max(max_confidence, float(conf.max()))
+
         # Save detection to database
         detection = CCTVDetection(
             location=request.location,
@@ -756,13 +1332,13 @@ async def detect_cctv_in_image(request: CCTVDetectionRequest):
             detections=detections,
             confidence=round(max_confidence, 3) if detections else 0
         )
-        
+
         doc = detection.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
+        doc['location'] = location_to_geojson(doc['location'])
         await db.cctv_detections.insert_one(doc)
-        
+
         logger.info(f"YOLOv8 detected {len(detections)} objects at {request.location}")
-        
+
         return {
             'success': True,
             'detection_id': detection.id,
@@ -771,32 +1347,7 @@ async def detect_cctv_in_image(request: CCTVDetectionRequest):
             'max_confidence': max_confidence if detections else 0,
             'source': 'YOLOv8'
         }
-        
-    except ImportError:
-        # YOLOv8 not installed, return mock detection
-        logger.warning("ultralytics YOLOv8 not installed, using mock detection")
-        mock_detections = [
-            {
-                'class': 'camera',
-                'confidence': 0.87,
-                'bbox': [245, 120, 310, 180]
-            }
-        ]
-        detection = CCTVDetection(
-            location=request.location,
-            image_url=request.image_url,
-            detections=mock_detections,
-            confidence=0.87
-        )
-        doc = detection.model_dump()
-        doc['created_at'] = doc['created_at'].isoformat()
-        await db.cctv_detections.insert_one(doc)
-        return {
-            'success': True,
-            'detection_id': detection.id,
-            'detections': mock_detections,
-            'note': 'YOLOv8 not installed - using mock detection'
-        }
+
     except Exception as e:
         logger.error(f"YOLO detection error: {e}")
         raise HTTPException(status_code=500, detail=f"Detection error: {str(e)}")
@@ -831,6 +1382,407 @@ async def confirm_cctv_detection(detection_id: str):
 
 # Track active users and their sessions
 active_users = {}  # {user_id: {'sid': sid, 'location': {...}, 'route': {...}}}
+sid_to_user = {}   # reverse index so disconnect cleanup is O(1), not a scan
+
+# last_seen is stored as a raw epoch float (time.time() is a single C call)
+# and only rendered to ISO-8601 when handed to clients; the rendered string
+# is cached per integer second since every stamp within a second formats
+# identically
+_last_seen_iso_cache = (0, '')
+
+def last_seen_iso(ts: float) -> str:
+    """ISO-8601 UTC string for an epoch stamp, cached at second granularity"""
+    global _last_seen_iso_cache
+    second = int(ts)
+    cached_second, cached = _last_seen_iso_cache
+    if second != cached_second:
+        cached = datetime.fromtimestamp(second, timezone.utc).isoformat()
+        _last_seen_iso_cache = (second, cached)
+    return cached
+
+# Crashed or suspended clients never send disconnect, so their rows would
+# sit in active_users (and the spatial indexes) forever, padding every
+# companions_list payload and proximity scan. A lazy expiry heap evicts
+# them: each presence/location write pushes (deadline, user_id), and reads
+# pop entries whose deadline has passed — re-checking last_seen so a user
+# who kept updating (and so has newer heap entries too) survives.
+PRESENCE_TTL = 120.0  # seconds without an update before a user is dropped
+_expiry_heap = []
+
+def evict_stale_users():
+    """Drop users whose last_seen is older than PRESENCE_TTL, amortized O(log N)"""
+    now = time.time()
+    while _expiry_heap and _expiry_heap[0][0] <= now:
+        _, user_id = heapq.heappop(_expiry_heap)
+        info = active_users.get(user_id)
+        if info is None or info['last_seen'] + PRESENCE_TTL > now:
+            continue
+        active_users.pop(user_id, None)
+        sid_to_user.pop(info.get('sid'), None)
+        spatial_index_remove(user_id)
+        pending_location_updates.pop(user_id, None)
+        logger.info(f"Evicted stale user {user_id}")
+
+# Socket event payloads validated once at the handler boundary — the
+# rust-backed pydantic-core check replaces the scattered .get()/truthiness
+# branching and the blanket try/except each handler used to carry
+class GeoPoint(BaseModel):
+    model_config = ConfigDict(extra="allow")  # clients may attach accuracy etc.
+    lat: float
+    lon: float
+
+class PresencePayload(BaseModel):
+    user_id: str
+    location: GeoPoint
+    route: Optional[dict] = None
+
+class LocationUpdatePayload(BaseModel):
+    user_id: str
+    location: GeoPoint
+
+class FindCompanionsPayload(BaseModel):
+    user_id: str
+    location: Optional[GeoPoint] = None
+    route: Optional[dict] = None
+    max_distance_km: float = 1.0
+
+class PresenceStore:
+    """Structure-of-arrays mirror of active user coordinates
+
+    The proximity path reads two contiguous float64 columns instead of
+    chasing nested dicts (one PyObject walk per user). Rows are kept dense
+    with swap-with-last deletes so vectorized kernels can run straight over
+    the populated prefix of the arrays. Radians-form columns are kept in
+    step with the degree columns: one math.radians per write saves an O(N)
+    np.radians pass (and its temporary array) on every proximity query.
+    """
+
+    def __init__(self, initial_capacity: int = 256):
+        self.ids: List[str] = []
+        self.id_to_row: dict = {}
+        self.lats = np.empty(initial_capacity, dtype=np.float64)
+        self.lons = np.empty(initial_capacity, dtype=np.float64)
+        self.lats_rad = np.empty(initial_capacity, dtype=np.float64)
+        self.lons_rad = np.empty(initial_capacity, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _grow(self):
+        capacity = len(self.lats) * 2
+        self.lats = np.resize(self.lats, capacity)
+        self.lons = np.resize(self.lons, capacity)
+        self.lats_rad = np.resize(self.lats_rad, capacity)
+        self.lons_rad = np.resize(self.lons_rad, capacity)
+
+    def upsert(self, user_id: str, lat: float, lon: float):
+        row = self.id_to_row.get(user_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self.lats):
+                self._grow()
+            self.ids.append(user_id)
+            self.id_to_row[user_id] = row
+        self.lats[row] = lat
+        self.lons[row] = lon
+        self.lats_rad[row] = math.radians(lat)
+        self.lons_rad[row] = math.radians(lon)
+
+    def remove(self, user_id: str):
+        row = self.id_to_row.pop(user_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            last_id = self.ids[last]
+            self.ids[row] = last_id
+            self.id_to_row[last_id] = row
+            self.lats[row] = self.lats[last]
+            self.lons[row] = self.lons[last]
+            self.lats_rad[row] = self.lats_rad[last]
+            self.lons_rad[row] = self.lons_rad[last]
+        self.ids.pop()
+
+presence_store = PresenceStore()
+
+# R-tree over active user locations: proximity queries prune candidates
+# with one bbox intersection (~O(log N + k)) instead of walking every user.
+# libspatialindex wants numeric ids, so user_ids are mapped to a counter.
+user_rtree = rtree_index.Index() if rtree_index is not None else None
+_rtree_ids = count()
+_rtree_entry = {}    # user_id -> (numeric id, (lon, lat)) currently indexed
+_rtree_user = {}     # numeric id -> user_id
+
+# Geohash buckets (~5km cells): a pure-Python locality partition that
+# serves as the candidate source when libspatialindex isn't installed
+GEO_BUCKET_PRECISION = 5
+GEO_BUCKET_CELL_KM = 4.9  # cell height at precision 5; widths only shrink
+_geo_buckets = {}    # cell -> set of user_ids
+_bucket_of = {}      # user_id -> cell currently holding it
+
+# Longitude band index: (lon, user_id) tuples kept sorted so a radius
+# search wider than one bucket cell can bisect out the vertical band
+# [lon-d, lon+d] in O(log N + k) instead of scanning every user
+_by_lon = SortedList()
+_lon_of = {}         # user_id -> lon currently indexed
+
+def _lon_band_update(user_id: str, lon: float):
+    old = _lon_of.get(user_id)
+    if old is not None:
+        if old == lon:
+            return
+        _by_lon.remove((old, user_id))
+    _by_lon.add((lon, user_id))
+    _lon_of[user_id] = lon
+
+def _lon_band_remove(user_id: str):
+    lon = _lon_of.pop(user_id, None)
+    if lon is not None:
+        _by_lon.remove((lon, user_id))
+
+def _lon_band_candidates(lon: float, delta_deg: float) -> List[str]:
+    return [
+        user_id for _, user_id in
+        _by_lon.irange((lon - delta_deg, ''), (lon + delta_deg, '\U0010ffff'))
+    ]
+
+def geohash_block(lat: float, lon: float, precision: int) -> set:
+    """The geohash cell containing a point plus its 8 neighbors"""
+    center = pygeohash.encode(lat, lon, precision=precision)
+    cells = {center}
+    try:
+        top = pygeohash.get_adjacent(center, 'top')
+        bottom = pygeohash.get_adjacent(center, 'bottom')
+        for row in (top, center, bottom):
+            cells.add(row)
+            cells.add(pygeohash.get_adjacent(row, 'left'))
+            cells.add(pygeohash.get_adjacent(row, 'right'))
+    except Exception:
+        # Cells at the poles/antimeridian may lack neighbors; the center
+        # cell alone still covers the point itself
+        pass
+    return cells
+
+def _bucket_update(user_id: str, lat: float, lon: float):
+    cell = pygeohash.encode(lat, lon, precision=GEO_BUCKET_PRECISION)
+    old_cell = _bucket_of.get(user_id)
+    if old_cell == cell:
+        return
+    if old_cell is not None:
+        bucket = _geo_buckets.get(old_cell)
+        if bucket is not None:
+            bucket.discard(user_id)
+            if not bucket:
+                del _geo_buckets[old_cell]
+    _geo_buckets.setdefault(cell, set()).add(user_id)
+    _bucket_of[user_id] = cell
+
+def _bucket_remove(user_id: str):
+    cell = _bucket_of.pop(user_id, None)
+    if cell is None:
+        return
+    bucket = _geo_buckets.get(cell)
+    if bucket is not None:
+        bucket.discard(user_id)
+        if not bucket:
+            del _geo_buckets[cell]
+
+def spatial_index_update(user_id: str, location: dict):
+    """Insert or move a user's point in the spatial index and SoA columns"""
+    lat, lon = location.get('lat'), location.get('lon')
+    if lat is None or lon is None:
+        return
+    presence_store.upsert(user_id, lat, lon)
+    _bucket_update(user_id, lat, lon)
+    _lon_band_update(user_id, lon)
+    if user_rtree is None:
+        return
+    entry = _rtree_entry.get(user_id)
+    if entry is not None:
+        num, (old_lon, old_lat) = entry
+        user_rtree.delete(num, (old_lon, old_lat, old_lon, old_lat))
+    else:
+        num = next(_rtree_ids)
+        _rtree_user[num] = user_id
+    user_rtree.insert(num, (lon, lat, lon, lat))
+    _rtree_entry[user_id] = (num, (lon, lat))
+
+def spatial_index_remove(user_id: str):
+    """Drop a user's point from the spatial index and SoA columns"""
+    presence_store.remove(user_id)
+    _bucket_remove(user_id)
+    _lon_band_remove(user_id)
+    entry = _rtree_entry.pop(user_id, None)
+    if entry is None:
+        return
+    num, (lon, lat) = entry
+    user_rtree.delete(num, (lon, lat, lon, lat))
+    _rtree_user.pop(num, None)
+
+EARTH_RADIUS_KM = 6371.0088
+EARTH_DIAMETER_KM = 2.0 * EARTH_RADIUS_KM  # the 2R factor, folded once
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# The haversine d = 2R*asin(sqrt(a)) is monotone in a for d up to half the
+# circumference, so culling compares a directly against a per-query
+# threshold max_a = sin^2(max_km / 2R) — an exact radius test that skips
+# the asin and sqrt on every rejected row
+def _haversine_max_a(max_km: float) -> float:
+    if max_km >= math.pi * EARTH_RADIUS_KM:
+        return 1.0  # radius spans the globe; nothing culls
+    s = math.sin(max_km / EARTH_DIAMETER_KM)
+    return s * s
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _proximity_kernel(lat0_rad, lon0_rad, lats_rad, lons_rad, max_a, out):
+        """Fused haversine + a-space cull over the candidate rows, no temporaries
+
+        Inputs are already in radians (the presence columns store both
+        forms), so the loop body is pure arithmetic; rejected rows never
+        reach the asin/sqrt. Culled rows get inf so callers can argsort
+        and stop at the radius. cache=True persists the compiled kernel,
+        so the JIT cost is paid once per machine rather than per process.
+        """
+        cos_lat0 = math.cos(lat0_rad)
+        for i in prange(lats_rad.shape[0]):
+            lat_rad = lats_rad[i]
+            sin_dlat = math.sin((lat_rad - lat0_rad) * 0.5)
+            sin_dlon = math.sin((lons_rad[i] - lon0_rad) * 0.5)
+            a = sin_dlat * sin_dlat + cos_lat0 * math.cos(lat_rad) * sin_dlon * sin_dlon
+            if a <= max_a:
+                out[i] = EARTH_DIAMETER_KM * math.asin(math.sqrt(a))
+            else:
+                out[i] = np.inf
+else:
+    _proximity_kernel = None
+
+def proximity_distances_km(lat0: float, lon0: float, lats_rad: np.ndarray,
+                           lons_rad: np.ndarray, max_distance_km: float) -> np.ndarray:
+    """Distances in km from one point (degrees) to candidate rows (radians)
+
+    The query point converts once; the candidate columns arrive already in
+    radians from the presence store, skipping an O(N) np.radians pass per
+    query. Uses the numba kernel when available (single fused pass,
+    parallel over rows, no temporary arrays); otherwise the vectorized
+    numpy form of the same a-space cull. Culled rows come back inf.
+    """
+    lat0_rad = math.radians(lat0)
+    lon0_rad = math.radians(lon0)
+    max_a = _haversine_max_a(max_distance_km)
+    if _proximity_kernel is not None:
+        out = np.empty(lats_rad.shape[0], dtype=np.float64)
+        _proximity_kernel(lat0_rad, lon0_rad, lats_rad, lons_rad, max_a, out)
+        return out
+
+    sin_dlat = np.sin((lats_rad - lat0_rad) * 0.5)
+    sin_dlon = np.sin((lons_rad - lon0_rad) * 0.5)
+    a = sin_dlat ** 2 + math.cos(lat0_rad) * np.cos(lats_rad) * sin_dlon ** 2
+    distances = np.full(lats_rad.shape[0], np.inf)
+    keep = np.nonzero(a <= max_a)[0]
+    if keep.size:
+        distances[keep] = EARTH_DIAMETER_KM * np.arcsin(np.sqrt(a[keep]))
+    return distances
+
+def spatial_index_candidates(lat: float, lon: float, max_distance_km: float) -> List[str]:
+    """User ids near a point, pruned by rtree bbox or geohash buckets
+
+    With rtree available the bbox covering the search radius is queried
+    directly; without it the 3x3 bucket block prunes to ~9 cells, which
+    covers any radius up to one cell height (~4.9km at precision 5).
+    Wider searches bisect the sorted-longitude band instead of scanning
+    every user. Each path returns a superset of the radius, since the
+    distance kernel downstream culls precisely.
+    """
+    lat_delta = max_distance_km / 111.0  # degrees of latitude spanning the radius
+    # Degrees of longitude shrink by cos(lat); the floor keeps the width
+    # finite near the poles (worst case: everything at that latitude)
+    lon_delta = max_distance_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+    if user_rtree is not None:
+        hits = user_rtree.intersection(
+            (lon - lon_delta, lat - lat_delta, lon + lon_delta, lat + lat_delta)
+        )
+        return [_rtree_user[num] for num in hits if num in _rtree_user]
+    if max_distance_km > GEO_BUCKET_CELL_KM:
+        return _lon_band_candidates(lon, lon_delta)
+    candidates = []
+    for cell in geohash_block(lat, lon, GEO_BUCKET_PRECISION):
+        candidates.extend(_geo_buckets.get(cell, ()))
+    return candidates
+
+# Clients are partitioned into geohash rooms (~5km cells) by their current
+# location so emergency fanout can target a neighborhood instead of every
+# connected client
+GEO_ROOM_PRECISION = 5
+
+def geo_room(lat: float, lon: float) -> str:
+    """Socket.IO room name for the geohash cell containing a point"""
+    return f"geo:{pygeohash.encode(lat, lon, precision=GEO_ROOM_PRECISION)}"
+
+def geo_rooms_around(lat: float, lon: float) -> List[str]:
+    """Rooms for the 3x3 block of geohash cells centered on a point"""
+    return [f"geo:{cell}" for cell in geohash_block(lat, lon, GEO_ROOM_PRECISION)]
+
+# Location broadcasts are coalesced: only the latest location per user is
+# kept, and one bulk event goes out per tick instead of one frame per
+# update — with N users updating at 1 Hz the per-update fanout is O(N^2)
+# frames/sec, the batched form O(N) payload rows per tick
+LOCATION_FLUSH_INTERVAL = 0.25
+pending_location_updates = {}  # user_id -> latest location
+
+async def flush_location_updates():
+    """Emit buffered location updates as one companion_bulk_location_update per tick"""
+    while True:
+        await asyncio.sleep(LOCATION_FLUSH_INTERVAL)
+        if not pending_location_updates:
+            continue
+        updates = [
+            {'user_id': user_id, 'location': location}
+            for user_id, location in pending_location_updates.items()
+        ]
+        pending_location_updates.clear()
+        try:
+            await sio.emit('companion_bulk_location_update', {
+                'updates': updates,
+                'count': len(updates)
+            })
+        except Exception as e:
+            logger.error(f"Error flushing location updates: {e}")
+
+async def update_geo_room(sid: str, user_id: str, location: dict):
+    """Keep a client's geohash-room membership in step with its location
+
+    Room membership belongs to the sid, not the user, so the recorded
+    room only counts if it was entered by this same sid — a client that
+    reconnects with a fresh sid inside the same cell must still enter the
+    room, or it silently drops off the neighborhood alert fanout once its
+    old connection is reaped.
+    """
+    lat, lon = location.get('lat'), location.get('lon')
+    if lat is None or lon is None:
+        return
+    info = active_users[user_id]
+    room = geo_room(lat, lon)
+    previous = info.get('geo_room')
+    previous_sid = info.get('geo_sid')
+    if previous == room and previous_sid == sid:
+        return
+    if previous and previous != room and previous_sid:
+        # Old and new room are distinct, so the leave and enter don't
+        # order-depend — run them concurrently (leave_room is a no-op if
+        # the old sid already disconnected)
+        await asyncio.gather(
+            sio.leave_room(previous_sid, previous),
+            sio.enter_room(sid, room)
+        )
+    else:
+        await sio.enter_room(sid, room)
+    info['geo_room'] = room
+    info['geo_sid'] = sid
 
 @sio.event
 async def connect(sid, environ):
@@ -844,15 +1796,12 @@ async def connect(sid, environ):
 async def disconnect(sid):
     """Handle client disconnection and cleanup"""
     logger.info(f"Client disconnected: {sid}")
-    # Remove user from active tracking
-    user_to_remove = None
-    for user_id, data in active_users.items():
-        if data.get('sid') == sid:
-            user_to_remove = user_id
-            break
-    
+    # Remove user from active tracking via the reverse index
+    user_to_remove = sid_to_user.pop(sid, None)
+
     if user_to_remove:
-        del active_users[user_to_remove]
+        active_users.pop(user_to_remove, None)
+        spatial_index_remove(user_to_remove)
         # Notify companions that user went offline
         await sio.emit('companion_offline', {'user_id': user_to_remove})
         logger.info(f"User {user_to_remove} marked offline")
@@ -861,109 +1810,174 @@ async def disconnect(sid):
 async def user_presence(sid, data):
     """Register user presence with location and route info"""
     try:
-        user_id = data.get('user_id')
-        location = data.get('location')  # {lat, lon}
-        route = data.get('route')  # {destination, distance, duration, safety_score}
-        
-        if not user_id or not location:
-            logger.warning(f"Invalid presence data from {sid}")
-            return
-        
-        # Store user presence
-        active_users[user_id] = {
-            'sid': sid,
+        payload = PresencePayload.model_validate(data)
+    except ValidationError:
+        logger.warning(f"Invalid presence data from {sid}")
+        return
+    user_id = payload.user_id
+    location = payload.location.model_dump()
+    route = payload.route
+
+    # Store user presence (carrying over the geo room and the sid that
+    # entered it, so re-registration knows whether the membership is
+    # still backed by a live connection)
+    previous = active_users.get(user_id, {})
+    active_users[user_id] = {
+        'sid': sid,
+        'location': location,
+        'route': route,
+        'geo_room': previous.get('geo_room'),
+        'geo_sid': previous.get('geo_sid'),
+        'last_seen': time.time()
+    }
+    heapq.heappush(_expiry_heap, (active_users[user_id]['last_seen'] + PRESENCE_TTL, user_id))
+    if previous.get('sid') and previous['sid'] != sid:
+        sid_to_user.pop(previous['sid'], None)
+    sid_to_user[sid] = user_id
+    spatial_index_update(user_id, location)
+
+    logger.info(f"User {user_id} online at {location}")
+
+    # Delta protocol: broadcast only the changed user instead of a full
+    # O(N) snapshot per presence event — clients that need the complete
+    # list request it once via get_companions. The room move and the
+    # broadcast are independent IO, so they overlap rather than queue.
+    await asyncio.gather(
+        update_geo_room(sid, user_id, location),
+        sio.emit('companion_presence', {
+            'user_id': user_id,
             'location': location,
-            'route': route,
-            'last_seen': datetime.now(timezone.utc).isoformat()
-        }
-        
-        logger.info(f"User {user_id} online at {location}")
-        
-        # Emit updated companion list to all clients
-        await sio.emit('companions_list', {
-            'companions': list(active_users.values())
-        })
-        
-    except Exception as e:
-        logger.error(f"Error handling user presence: {e}")
+            'route': route
+        }, skip_sid=sid)
+    )
+
+@sio.on('get_companions')
+async def companions_snapshot(sid, data=None):
+    """Send the requesting client a full snapshot of active companions"""
+    evict_stale_users()
+    companions = []
+    for info in active_users.values():
+        entry = dict(info)
+        entry['last_seen'] = last_seen_iso(entry['last_seen'])
+        companions.append(entry)
+    await sio.emit('companions_list', {
+        'companions': companions
+    }, to=sid)
 
 @sio.event
 async def location_update(sid, data):
     """Handle real-time location updates from users on active routes"""
     try:
-        user_id = data.get('user_id')
-        location = data.get('location')  # {lat, lon, accuracy}
-        
-        if user_id in active_users:
-            active_users[user_id]['location'] = location
-            active_users[user_id]['last_seen'] = datetime.now(timezone.utc).isoformat()
-            
-            # Broadcast to companions
-            await sio.emit('companion_location_update', {
-                'user_id': user_id,
-                'location': location
-            }, skip_sid=sid)
-            
-            logger.debug(f"Location update for user {user_id}: {location}")
-    except Exception as e:
-        logger.error(f"Error handling location update: {e}")
+        payload = LocationUpdatePayload.model_validate(data)
+    except ValidationError:
+        logger.warning(f"Invalid location update from {sid}")
+        return
+    user_id = payload.user_id
+    location = payload.location.model_dump()
+
+    if user_id in active_users:
+        active_users[user_id]['location'] = location
+        active_users[user_id]['last_seen'] = time.time()
+        heapq.heappush(_expiry_heap, (active_users[user_id]['last_seen'] + PRESENCE_TTL, user_id))
+        await update_geo_room(sid, user_id, location)
+        spatial_index_update(user_id, location)
+
+        # Buffer for the throttled bulk broadcast; clients merge the
+        # batched payload (and drop their own entry) on receipt
+        pending_location_updates[user_id] = location
+
+        logger.debug(f"Location update for user {user_id}: {location}")
 
 @sio.event
 async def find_companions(sid, data):
     """Find compatible companions based on route proximity"""
     try:
-        user_id = data.get('user_id')
-        location = data.get('location')  # {lat, lon}
-        route = data.get('route')  # {destination, waypoints}
-        max_distance_km = data.get('max_distance_km', 1.0)  # Search within 1 km
-        
-        if user_id not in active_users:
-            return
-        
-        user_location = active_users[user_id]['location']
-        nearby_companions = []
-        
-        # Find companions within proximity
-        for comp_id, comp_data in active_users.items():
-            if comp_id == user_id:
-                continue
-            
-            comp_location = comp_data['location']
-            # Simple distance calculation (Haversine would be more accurate)
-            distance = ((comp_location['lat'] - user_location['lat'])**2 + 
-                       (comp_location['lon'] - user_location['lon'])**2)**0.5
-            distance_km = distance * 111  # Rough conversion to km
-            
-            if distance_km <= max_distance_km:
-                nearby_companions.append({
-                    'user_id': comp_id,
-                    'distance_km': round(distance_km, 2),
-                    'location': comp_location,
-                    'route': comp_data.get('route')
-                })
-        
-        # Sort by distance
-        nearby_companions.sort(key=lambda x: x['distance_km'])
-        
-        # Send to user
-        await sio.emit('companions_found', {
-            'user_id': user_id,
-            'count': len(nearby_companions),
-            'companions': nearby_companions
-        }, to=sid)
-        
-        logger.info(f"Found {len(nearby_companions)} companions for user {user_id}")
-        
-    except Exception as e:
-        logger.error(f"Error finding companions: {e}")
+        payload = FindCompanionsPayload.model_validate(data)
+    except ValidationError:
+        logger.warning(f"Invalid find_companions request from {sid}")
+        return
+    user_id = payload.user_id
+    max_distance_km = payload.max_distance_km  # Search within 1 km by default
+
+    evict_stale_users()
+    if user_id not in active_users:
+        return
+
+    user_location = active_users[user_id]['location']
+    nearby_companions = []
+
+    # Find companions within proximity, pruning candidates through the
+    # spatial index so only users in the search bbox are examined
+    candidates = [
+        comp_id for comp_id in spatial_index_candidates(
+            user_location['lat'], user_location['lon'], max_distance_km
+        )
+        if comp_id != user_id
+        and comp_id in active_users
+        and comp_id in presence_store.id_to_row
+    ]
+
+    if candidates:
+        # Distances fed straight from the contiguous SoA coordinate
+        # columns — no per-candidate dict chasing. The kernel compares
+        # each row's haversine intermediate against the precomputed
+        # a-space radius threshold, finishing the asin/sqrt only for
+        # rows inside it (culled rows come back inf)
+        rows = [presence_store.id_to_row[comp_id] for comp_id in candidates]
+        distances_km = proximity_distances_km(
+            user_location['lat'], user_location['lon'],
+            presence_store.lats_rad[rows],
+            presence_store.lons_rad[rows],
+            max_distance_km
+        )
+
+        # argsort yields the companions already ordered by distance
+        for i in np.argsort(distances_km):
+            distance_km = float(distances_km[i])
+            if distance_km > max_distance_km:
+                break
+            comp_id = candidates[int(i)]
+            comp_data = active_users[comp_id]
+            nearby_companions.append({
+                'user_id': comp_id,
+                'distance_km': round(distance_km, 2),
+                'location': comp_data['location'],
+                'route': comp_data.get('route')
+            })
+
+    # Send to user
+    await sio.emit('companions_found', {
+        'user_id': user_id,
+        'count': len(nearby_companions),
+        'companions': nearby_companions
+    }, to=sid)
+
+    logger.info(f"Found {len(nearby_companions)} companions for user {user_id}")
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Parse CORS_ORIGINS once at import: strip stray whitespace from the
+# comma-separated env value, and for explicit origin lists hand Starlette
+# a compiled alternation regex instead of a list — origin checks then hit
+# one anchored re.match rather than a Python-level walk per preflight
+_cors_origins = [
+    origin.strip()
+    for origin in os.environ.get('CORS_ORIGINS', '*').split(',')
+    if origin.strip()
+]
+if '*' in _cors_origins or not _cors_origins:
+    _cors_kwargs = {'allow_origins': ['*']}
+else:
+    _cors_kwargs = {
+        'allow_origin_regex':
+            '^(?:' + '|'.join(re.escape(origin) for origin in _cors_origins) + ')$'
+    }
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    **_cors_kwargs,
 )